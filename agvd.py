@@ -1,22 +1,39 @@
 #!/usr/bin/env python
 
 import argparse
+import csv
+import gzip
+import importlib.util
 import logging
 import math
 import re
 import time
 import os
-import json
 from tqdm import tqdm
 from pysam import VariantFile
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
+from diskcache import Cache
 from exceptions import AgvdException, HTTP_STATUS_CODES
-from functools import lru_cache, partial
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict, deque
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 logger = logging.getLogger(__name__)
 
+_SESSION = requests.Session()
+_CACHE_DIR = os.path.expanduser('~/.agvd_cache')
+_CACHE_EXPIRE = 86400
+_MISSING = object()
+_MIN_BATCH = 50
+_MAX_BATCH = 5000
+_FAST_BATCH_SECONDS = 1.0
+_GZIP_BODY = False
+
 
 def arguments():
     parser = argparse.ArgumentParser(prog="AGVD", description="AGVD Variant Query Filter")
@@ -32,8 +49,11 @@ def arguments():
     parser.add_argument("--ALT", help="Alternate allele column name", type=str)
     parser.add_argument("--verbose", help="Enable verbose output", action='store_true')
     parser.add_argument("--dry-run", help="Only validate the input file without submitting queries", action='store_true')
-    parser.add_argument("--cache", help="Enable local caching of queries", action='store_true')
+    parser.add_argument("--cache", help="Enable on-disk caching of query results", action='store_true')
     parser.add_argument("--threads", help="Number of threads for parallel execution", type=int, default=4)
+    parser.add_argument("--adaptive-batch", help="Grow or shrink the batch size based on API response times", action='store_true')
+    parser.add_argument("--gzip", help="Gzip-compress query request bodies", action='store_true')
+    parser.add_argument("--fast-io", help="Write CSV/TSV output with pyarrow when it is installed", action='store_true')
     return parser
 
 
@@ -44,33 +64,66 @@ def setup_logging(verbose=False):
     )
 
 
-def standardize_variant_id(raw_id):
-    raw_id = raw_id.strip()
-
-    if re.match(r"^rs\d+$", raw_id, re.IGNORECASE):
-        return raw_id, "rsID"
-
-    raw_id = raw_id.lower().replace("chr", "")
-    patterns = [
-        r'(?P<chr>\w+)[_|:|\-|>|\|](?P<pos>\d+)[_|:|\-|>|\|](?P<ref>\w+)[_|:|\-|>|\|](?P<alt>\w+)',
-        r'(?P<chr>\w+):(?P<pos>\d+):(?P<ref>\w+):(?P<alt>\w+)',
-        r'(?P<chr>\w+):(?P<pos>\d+):(?P<ref>\w+)[>](?P<alt>\w+)'
-    ]
-    for pattern in patterns:
-        match = re.match(pattern, raw_id)
-        if match:
-            std_id = f"{match.group('chr')}_{match.group('pos')}_{match.group('ref')}_{match.group('alt')}"
-            return std_id.upper(), "variantID"
-
-    raise ValueError(f"Unrecognized variant ID format: {raw_id}")
-
-
-@lru_cache(maxsize=5000)
-def submit_query_cached(key, ids, threshold, id_type):
-    return submit_query(ids, threshold, id_type)
+_RS_RE = re.compile(r"^rs\d+$", re.IGNORECASE)
+_VAR_RE = re.compile(r'^(?P<chr>\w+)[_:\->|](?P<pos>\d+)[_:\->|](?P<ref>\w+)[_:\->|](?P<alt>\w+)')
+
+
+def standardize_variant_ids(ids):
+    # Each distinct ID is classified once and the result broadcast back, since
+    # merged call sets repeat IDs heavily.
+    codes, uniques = pd.factorize(ids.astype('string').str.strip())
+    u = pd.Series(uniques, dtype='string')
+    u_rs = u.str.match(_RS_RE, na=False).to_numpy()
+    parts = u.str.lower().str.replace(r'^chr', '', regex=True).str.extract(_VAR_RE)
+    u_var = (parts['chr'] + '_' + parts['pos'] + '_' + parts['ref'] + '_' + parts['alt']).str.upper()
+    u_std = np.where(u_rs, u.to_numpy(dtype=object), u_var.to_numpy(dtype=object, na_value=None))
+    u_var_mask = ~u_rs & u_var.notna().to_numpy()
+
+    # Missing IDs are coded -1 by factorize and pick up the trailing sentinel.
+    u_std, u_rs, u_var_mask = np.append(u_std, None), np.append(u_rs, False), np.append(u_var_mask, False)
+    return u_std[codes], u_rs[codes], u_var_mask[codes]
+
+
+def configure_session(threads, gzip_body=False):
+    global _GZIP_BODY
+    _GZIP_BODY = gzip_body
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=frozenset(['POST']), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads * 2, max_retries=retry)
+    _SESSION.mount("https://", adapter)
+    _SESSION.mount("http://", adapter)
+
+
+def index_results(results):
+    idx = {}
+    for r in results:
+        for key in (r.get('variantID'), r.get('rsID')):
+            if key is not None:
+                idx.setdefault(key, r)
+    return idx
+
+
+def submit_query_cached(cache, ids, threshold, id_type):
+    results, uncached = [], []
+    for rid in ids:
+        hit = cache.get(f"{id_type}:{threshold}:{rid}", default=_MISSING)
+        if hit is _MISSING:
+            uncached.append(rid)
+        elif hit is not None:
+            results.append(hit)
+
+    if uncached:
+        fresh = index_results(submit_query(uncached, threshold, id_type))
+        for rid in uncached:
+            r = fresh.get(rid)
+            cache.set(f"{id_type}:{threshold}:{rid}", r, expire=_CACHE_EXPIRE)
+            if r is not None:
+                results.append(r)
+    return results
 
 
 def submit_query(identifiers, threshold, id_type):
+    global _GZIP_BODY
     url = "https://agvd-rps.h3abionet.org/devo/"
     headers = {'content-type': 'application/json'}
 
@@ -88,24 +141,23 @@ def submit_query(identifiers, threshold, id_type):
     }'''
 
     variables = {"input": {id_type: identifiers, "threshold": threshold}}
-    response = requests.post(url, headers=headers, json={"query": query, "variables": variables})
+    body = orjson.dumps({"query": query, "variables": variables})
+    response = None
+    if _GZIP_BODY:
+        gz_headers = {**headers, 'content-encoding': 'gzip'}
+        response = _SESSION.post(url, headers=gz_headers, data=gzip.compress(body, compresslevel=1))
+        if response.status_code in (400, 415):
+            logger.debug("Compressed request body rejected, sending uncompressed requests from now on")
+            _GZIP_BODY = False
+            response = None
+    if response is None:
+        response = _SESSION.post(url, headers=headers, data=body)
 
     if response.status_code == 200:
-        return response.json()['data']['cliVariantSearch']
+        return orjson.loads(response.content)['data']['cliVariantSearch']
     else:
-        raise AgvdException(HTTP_STATUS_CODES.get(response.status_code, {"message": "Unknown error"})["message"])
-
-
-def get_result_info(variant_id, results):
-    for result in results:
-        if result.get('variantID') == variant_id or result.get('rsID') == variant_id:
-            return {
-                "mafThreshold": result.get("mafThreshold"),
-                "status": result.get("agvdThresholdStatus", "UNKNOWN"),
-                "usedThreshold": result.get("usedThreshold"),
-                "clusters": {c['name']: c['maf'] for c in result.get("clusters", [])}
-            }
-    return {"mafThreshold": None, "status": "NO MATCH", "usedThreshold": None, "clusters": {}}
+        raise AgvdException(HTTP_STATUS_CODES.get(response.status_code, {"message": "Unknown error"})["message"],
+                            status=response.status_code)
 
 
 def generate_summary(total, success, fail):
@@ -118,112 +170,325 @@ def generate_summary(total, success, fail):
 
 
 def write_summary(summary, path):
-    with open(path, 'w') as f:
-        json.dump(summary, f, indent=2)
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+
+def arrow_table(df):
+    import pyarrow as pa
+
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Object columns mixing str with other scalars (e.g. "24" next to 24)
+        # cannot be typed by Arrow; write those as text.
+        df = df.copy()
+        for col in df.columns[df.dtypes == object]:
+            values = df[col]
+            if len(set(map(type, values.dropna()))) > 1:
+                df[col] = values.where(values.isna(), values.astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_table(df, path, ext, fast_io=False, append=False):
+    if path.lower().endswith(".parquet"):
+        import pyarrow.parquet as pq
+        pq.write_table(arrow_table(df), path, compression='zstd')
+        return
+
+    sep = '\t' if ext == "tsv" else ','
+    if fast_io and ext in ("csv", "tsv"):
+        try:
+            from pyarrow import csv as pa_csv
+        except ImportError:
+            logger.warning("pyarrow is not installed, falling back to pandas for output")
+        else:
+            options = pa_csv.WriteOptions(delimiter=sep, include_header=not append)
+            with open(path, 'ab' if append else 'wb') as f:
+                pa_csv.write_csv(arrow_table(df), f, write_options=options)
+            return
+
+    if ext in ("csv", "tsv"):
+        df.to_csv(path, sep=sep, index=False, mode='a' if append else 'w', header=not append)
+    else:
+        df.to_excel(path, index=False)
 
 
-def construct_variant_id(row, chr_col, pos_col, ref_col, alt_col):
-    return f"{str(row[chr_col]).lstrip('chr')}_{int(row[pos_col])}_{row[ref_col]}_{row[alt_col]}"
+def widen_csv_header(path, ext, columns):
+    # Rows written before a cluster column first appeared are shorter than the
+    # final header; pad them so every row has the same fields.
+    sep = '\t' if ext == "tsv" else ','
+    tmp_path = path + '.tmp'
+    with open(path, newline='') as src, open(tmp_path, 'w', newline='') as dst:
+        reader = csv.reader(src, delimiter=sep)
+        writer = csv.writer(dst, delimiter=sep)
+        next(reader, None)
+        writer.writerow(columns)
+        for row in reader:
+            writer.writerow(row + [''] * (len(columns) - len(row)))
+    os.replace(tmp_path, path)
 
 
 def process_vcf(args):
     vcf = VariantFile(args.INFILE)
-    rows = [f"{str(rec.chrom).lstrip('chr')}_{rec.pos}_{rec.ref}_{rec.alts[0]}" for rec in vcf]
-    df = pd.DataFrame({'variant_id': rows})
+    chroms, poss, refs, alts = [], [], [], []
+    for rec in vcf:
+        chroms.append(rec.chrom)
+        poss.append(rec.pos)
+        refs.append(rec.ref)
+        alts.append(rec.alts[0] if rec.alts else None)
+    chrom = pd.Series(chroms, dtype='string').str.removeprefix('chr')
+    others = [pd.Series(col, dtype='string') for col in (poss, refs, alts)]
+    df = pd.DataFrame({'variant_id': chrom.str.cat(others, sep='_', na_rep='.')})
     args.COLUMN = 'variant_id'
     args.CHR = args.POS = args.REF = args.ALT = None
-    args.INFILE = args.OUTPUT + '.tmp.csv'
-    df.to_csv(args.INFILE, index=False)
-    process_table(args)
-    os.remove(args.INFILE)
-
+    process_table(args, df=df)
+
+
+def read_table_chunks(path, ext, chunksize=None):
+    # Chunks are read as text: pandas would otherwise infer types per chunk,
+    # and a passthrough column such as "0001" could come back as 1. Text
+    # output then reproduces every input cell exactly.
+    if ext in ("csv", "tsv"):
+        sep = '\t' if ext == "tsv" else ','
+        if chunksize is None:
+            return [pd.read_csv(path, sep=sep)]
+        return pd.read_csv(path, sep=sep, chunksize=chunksize, dtype=str, keep_default_na=False)
+    if importlib.util.find_spec("python_calamine") is not None:
+        try:
+            return [pd.read_excel(path, engine='calamine')]
+        except ValueError:
+            logger.debug("pandas does not support the calamine engine, falling back to openpyxl")
+    return [pd.read_excel(path)]
 
-def process_table(args):
-    ext = args.INFILE.split(".")[-1].lower()
-    df = pd.read_csv(args.INFILE) if ext == "csv" else (
-         pd.read_csv(args.INFILE, sep='\t') if ext == "tsv" else pd.read_excel(args.INFILE))
 
+def process_table(args, df=None):
     if not args.COLUMN and not all([args.CHR, args.POS, args.REF, args.ALT]):
         raise ValueError("You must specify either --COLUMN for variant IDs or all of --CHR, --POS, --REF, and --ALT")
 
-    if not args.COLUMN:
-        df['__variant_id__'] = df.apply(lambda row: construct_variant_id(row, args.CHR, args.POS, args.REF, args.ALT), axis=1)
-        variant_col = '__variant_id__'
+    if args.OUTPUT.lower().endswith(".parquet") and importlib.util.find_spec("pyarrow") is None:
+        raise ValueError("Parquet output requires pyarrow; install it with 'pip install agvd[fast]'")
+
+    if df is None:
+        ext = args.INFILE.split(".")[-1].lower()
     else:
-        if args.COLUMN not in df.columns:
-            raise ValueError(f"Column '{args.COLUMN}' not found in file")
-        variant_col = args.COLUMN
+        ext = "csv"
+    # CSV/TSV output is written chunk by chunk as results come in; Excel and
+    # Parquet can't be appended to, so those read and write the whole table.
+    streaming = ext in ("csv", "tsv") and not args.OUTPUT.lower().endswith(".parquet")
+    batch_size = args.BATCH
+    max_batch = max(_MAX_BATCH, args.BATCH) if args.adaptive_batch else args.BATCH
+    min_batch = min(_MIN_BATCH, args.BATCH)
+    if df is not None:
+        chunks = [df]
+    elif streaming:
+        chunks = read_table_chunks(args.INFILE, ext, max_batch * 4)
+    else:
+        chunks = read_table_chunks(args.INFILE, ext)
 
-    ids = df[variant_col].astype(str).tolist()
+    totals = {"ids": 0, "success": 0, "fail": 0}
+    cache = Cache(_CACHE_DIR) if args.cache and not args.dry_run else None
 
-    id_batches = {"variantID": [], "rsID": []}
-    row_map = {"variantID": [], "rsID": []}
-    for idx, rid in enumerate(ids):
-        try:
-            std_id, id_type = standardize_variant_id(rid)
-            id_batches[id_type].append(std_id)
-            row_map[id_type].append(idx)
-        except ValueError:
-            df.loc[idx, 'AGVDCUTOFF'] = 'INVALID'
-
-    total_success, total_fail = 0, 0
+    def fetch_batch(batch, id_type):
+        start = time.monotonic()
+        if cache is not None:
+            results = submit_query_cached(cache, batch, args.THRESHOLD, id_type)
+        else:
+            results = submit_query(batch, args.THRESHOLD, id_type)
+        return results, time.monotonic() - start
 
-    def process_batch(batch, batch_rows, id_type):
-        local_success, local_fail = 0, 0
+    def merge_batch(future):
+        nonlocal batch_size, max_batch
+        id_type, batch, parts = futures.pop(future)
         try:
-            if args.dry_run:
-                logger.info(f"Dry run: would submit {len(batch)} {id_type}s")
-                return local_success, local_fail
-            results = submit_query_cached(args.KEY, tuple(batch), args.THRESHOLD, id_type) if args.cache else submit_query(batch, args.THRESHOLD, id_type)
-            for j, rid in enumerate(batch):
-                row_idx = batch_rows[j]
-                info = get_result_info(rid, results)
-                df.loc[row_idx, 'THRESHOLD'] = info['usedThreshold']
-                df.loc[row_idx, 'AGVDCUTOFF'] = info['status']
-                df.loc[row_idx, 'African_MAF'] = info['mafThreshold']
-                for cname, maf in info['clusters'].items():
-                    df.loc[row_idx, f"{cname}_MAF"] = maf
-                local_success += 1
-        except Exception as e:
+            results, elapsed = future.result()
+        except (Exception, AgvdException) as e:
+            # Only overload and connection failures say anything about the
+            # batch size; anything else would fail at any size.
+            status = getattr(e, "status", None) or 0
+            transient = (status == 429 or status >= 500
+                         or isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)))
+            if args.adaptive_batch and transient:
+                if len(batch) == batch_size:
+                    # Don't grow back into a size the server has rejected.
+                    batch_size = max_batch = max(batch_size // 2, min_batch)
+                if len(batch) > batch_size:
+                    logger.warning(f"Batch of {len(batch)} failed ({e}), retrying in batches of {batch_size}")
+                    for chunk, ids, rows in reversed(parts):
+                        pending[id_type].appendleft([ids, rows, chunk, 0])
+                    queued[id_type] += len(batch)
+                    return
             logger.error(f"Batch failed: {e}")
-            for row_idx in batch_rows:
-                df.loc[row_idx, 'THRESHOLD'] = args.THRESHOLD
-                df.loc[row_idx, 'AGVDCUTOFF'] = 'ERROR'
-                df.loc[row_idx, 'African_MAF'] = None
-                local_fail += 1
-        return local_success, local_fail
-
+            for chunk, ids, rows in parts:
+                threshold_arr, status_arr, maf_arr, _ = chunk["out"]
+                threshold_arr[rows] = args.THRESHOLD
+                status_arr[rows] = 'ERROR'
+                maf_arr[rows] = np.nan
+                chunk["remaining"] -= len(ids)
+            totals["fail"] += len(batch)
+            return
+
+        idx = index_results(results)
+        for chunk, ids, rows in parts:
+            threshold_arr, status_arr, maf_arr, cluster_arrays = chunk["out"]
+            for j, rid in enumerate(ids):
+                row_idx = rows[j]
+                r = idx.get(rid)
+                if r is None:
+                    status_arr[row_idx] = 'NO MATCH'
+                else:
+                    maf = r.get('mafThreshold')
+                    threshold_arr[row_idx] = r.get('usedThreshold')
+                    status_arr[row_idx] = r.get('agvdThresholdStatus', 'UNKNOWN')
+                    maf_arr[row_idx] = np.nan if maf is None else maf
+                    for c in r.get('clusters', []):
+                        cmaf = c['maf']
+                        cluster_arrays[c['name']][row_idx] = np.nan if cmaf is None else cmaf
+            chunk["remaining"] -= len(ids)
+        totals["success"] += len(batch)
+        # Only a batch cut at the current size says anything about it, so
+        # the size changes at most once per round trip.
+        if args.adaptive_batch and elapsed < _FAST_BATCH_SECONDS and len(batch) == batch_size:
+            batch_size = min(batch_size * 2, max_batch)
+
+    def cut_batch(id_type):
+        # A batch may span several chunks, so only the last one of the whole
+        # input is ever short.
+        batch, parts = [], []
+        segments = pending[id_type]
+        while segments and len(batch) < batch_size:
+            segment = segments[0]
+            ids, rows, chunk, start = segment
+            end = min(start + batch_size - len(batch), len(ids))
+            batch.extend(ids[start:end])
+            parts.append((chunk, ids[start:end], rows[start:end]))
+            if end == len(ids):
+                segments.popleft()
+            else:
+                segment[3] = end
+        queued[id_type] -= len(batch)
+        return batch, parts
+
+    def submit_pending(final=False):
+        # Batches are cut from the pending IDs only when a slot frees up, so
+        # that a batch size change applies to the very next request.
+        for id_type in pending:
+            while len(futures) < window and (queued[id_type] >= batch_size or (final and queued[id_type])):
+                batch, parts = cut_batch(id_type)
+                futures[executor.submit(fetch_batch, batch, id_type)] = (id_type, batch, parts)
+
+    def flush_chunks():
+        # Chunks are written in input order once all of their batches are in.
+        nonlocal header_width
+        while chunks_open and chunks_open[0]["remaining"] == 0 and not args.dry_run:
+            chunk = chunks_open.popleft()
+            df = chunk["df"]
+            threshold_arr, status_arr, maf_arr, cluster_arrays = chunk["out"]
+            df['THRESHOLD'] = threshold_arr
+            df['AGVDCUTOFF'] = status_arr
+            df['African_MAF'] = maf_arr
+            for cname, values in cluster_arrays.items():
+                df[f"{cname}_MAF"] = values
+            if not streaming:
+                frames.append(df)
+                continue
+            columns.extend(col for col in df.columns if col not in columns)
+            write_table(df.reindex(columns=columns), args.OUTPUT, ext, args.fast_io, append=header_width > 0)
+            header_width = header_width or len(columns)
+
+    def harvest(block):
+        done = wait(futures, return_when=FIRST_COMPLETED)[0] if block else [f for f in futures if f.done()]
+        for future in done:
+            merge_batch(future)
+
+    # Batches are submitted as soon as their chunk is parsed, so network I/O
+    # overlaps with reading the rest of the file. Worker threads only wait on
+    # the network; results are merged into each chunk's arrays here.
+    chunks_open, frames, columns = deque(), [], []
+    header_width = 0
+    pending = {"variantID": deque(), "rsID": deque()}
+    queued = {"variantID": 0, "rsID": 0}
+    dry_counts = {"variantID": 0, "rsID": 0}
+    futures = {}
+    window = args.threads * 2
     with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        futures = []
-        for id_type in id_batches:
-            ids_batch = id_batches[id_type]
-            rows = row_map[id_type]
-            for i in range(0, len(ids_batch), args.BATCH):
-                batch = ids_batch[i:i + args.BATCH]
-                batch_rows = rows[i:i + args.BATCH]
-                futures.append(executor.submit(process_batch, batch, batch_rows, id_type))
-
-        for future in as_completed(futures):
-            success, fail = future.result()
-            total_success += success
-            total_fail += fail
-
-    if not args.dry_run:
-        if ext == "csv":
-            df.to_csv(args.OUTPUT, index=False)
-        elif ext == "tsv":
-            df.to_csv(args.OUTPUT, sep='\t', index=False)
-        else:
-            df.to_excel(args.OUTPUT, index=False)
+        for df in chunks:
+            if not args.COLUMN:
+                chrom = df[args.CHR].astype(str).str.replace(r'^chr', '', regex=True)
+                pos = pd.to_numeric(df[args.POS]).astype(int).astype(str)
+                df['__variant_id__'] = chrom.str.cat([pos, df[args.REF].astype(str), df[args.ALT].astype(str)], sep='_')
+                variant_col = '__variant_id__'
+            else:
+                if args.COLUMN not in df.columns:
+                    raise ValueError(f"Column '{args.COLUMN}' not found in file")
+                variant_col = args.COLUMN
+
+            n_rows = len(df)
+            totals["ids"] += n_rows
+            std_ids, rs_mask, var_mask = standardize_variant_ids(df[variant_col])
+            chunk = {
+                "df": df,
+                "out": (
+                    np.empty(n_rows, dtype=object),
+                    np.empty(n_rows, dtype=object),
+                    np.full(n_rows, np.nan),
+                    defaultdict(lambda n=n_rows: np.full(n, np.nan))
+                ),
+                "remaining": 0 if args.dry_run else int(rs_mask.sum() + var_mask.sum())
+            }
+            chunk["out"][1][~(rs_mask | var_mask)] = 'INVALID'
+            chunks_open.append(chunk)
+
+            for id_type, mask in (("variantID", var_mask), ("rsID", rs_mask)):
+                ids = std_ids[mask].tolist()
+                if args.dry_run:
+                    dry_counts[id_type] += len(ids)
+                elif ids:
+                    pending[id_type].append([ids, np.flatnonzero(mask).tolist(), chunk, 0])
+                    queued[id_type] += len(ids)
+
+            harvest(block=False)
+            submit_pending()
+            # Don't read further ahead than the requests in flight can use.
+            while futures and sum(queued.values()) >= window * batch_size:
+                harvest(block=True)
+                submit_pending()
+                flush_chunks()
+            flush_chunks()
+
+        submit_pending(final=True)
+        while futures:
+            harvest(block=True)
+            submit_pending(final=True)
+            flush_chunks()
+        flush_chunks()
+
+    if cache is not None:
+        cache.close()
+
+    if args.dry_run:
+        for id_type, n_ids in dry_counts.items():
+            for i in range(0, n_ids, args.BATCH):
+                logger.info(f"Dry run: would submit {min(args.BATCH, n_ids - i)} {id_type}s")
+        return
+
+    if streaming:
+        if not header_width:
+            write_table(pd.DataFrame(), args.OUTPUT, ext, args.fast_io)
+        elif len(columns) > header_width:
+            widen_csv_header(args.OUTPUT, ext, columns)
+    else:
+        write_table(pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(), args.OUTPUT, ext, args.fast_io)
 
-        summary = generate_summary(len(ids), total_success, total_fail)
-        summary_path = os.path.splitext(args.OUTPUT)[0] + "_summary.json"
-        write_summary(summary, summary_path)
-        logger.info(f"Summary written to {summary_path}")
+    summary = generate_summary(totals["ids"], totals["success"], totals["fail"])
+    summary_path = os.path.splitext(args.OUTPUT)[0] + "_summary.json"
+    write_summary(summary, summary_path)
+    logger.info(f"Summary written to {summary_path}")
 
 def run(args):
     setup_logging(args.verbose)
     logger.info("Starting AGVD Variant Processing")
+    configure_session(args.threads, args.gzip)
 
     if args.INFILE.lower().endswith(".vcf.gz") or args.INFILE.lower().endswith(".vcf"):
         process_vcf(args)
@@ -1,5 +1,7 @@
 class AgvdException(BaseException):
-    pass
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
 
 HTTP_STATUS_CODES = {
     100: { 'code': 100, 'message': "Continue - The server has received the request headers and you should proceed to send the request body." },
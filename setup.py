@@ -15,9 +15,15 @@ setup(
         'pysam',
         'tqdm',
         'requests',
-        'pandas',
+        'orjson',
+        'diskcache',
+        'pandas>=1.4',
+        'numpy',
         'openpyxl'  # for Excel file support
     ],
+    extras_require={
+        'fast': ['pyarrow', 'python-calamine']
+    },
     entry_points={
         'console_scripts': [
             'agvd=agvd:main'
@@ -28,5 +34,5 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
     ],
-    python_requires='>=3.7',
+    python_requires='>=3.8',
 )